@@ -1,9 +1,14 @@
+from textwrap import dedent
+
 from lark import Lark, Tree, Token, UnexpectedToken
+from lark.indenter import PythonIndenter
 from pytest import mark
 import pytest
 
 grammar_path = "grammar/snakemake.lark"
-LARK = Lark.open(grammar_path, parser="lalr", start="file_input")
+LARK = Lark.open(
+    grammar_path, parser="lalr", start="file_input", postlex=PythonIndenter()
+)
 
 
 @mark.parametrize(
@@ -147,7 +152,7 @@ LARK = Lark.open(grammar_path, parser="lalr", start="file_input")
     ],
 )
 def test_parse_snakemake_file(snakefile):
-    tree = lark.parse(snakefile)
+    tree = LARK.parse(dedent(snakefile))
     print(tree.pretty())
 
 
@@ -157,30 +162,39 @@ def test_parse_snakemake_param():
         input: "file1.txt"
         output: "output1.txt"
     """
-    tree = lark.parse(snakefile)
+    tree = LARK.parse(dedent(snakefile))
     print(tree.pretty())
     assert len(tree.children) == 1
-    assert tree.children[0].data == "rule"
+    assert tree.children[0].data == "snakemake"
     assert len(tree.children[0].children) == 1
-    assert tree.children[0].children[0].data == "rule_def"
+    assert tree.children[0].children[0].data == "ruledef"
     assert len(tree.children[0].children[0].children) == 3
-    assert tree.children[0].children[0].children[0].data == "rule_header"
-    assert tree.children[0].children[0].children[1].data == "rule_input"
-    assert tree.children[0].children[0].children[2].data == "rule_output"
+    assert tree.children[0].children[0].children[0].type == "NAME"
+    assert tree.children[0].children[0].children[1].data == "ruleparams"
+    assert tree.children[0].children[0].children[2].data == "ruleparams"
 
-    rule_header = tree.children[0].children[0].children[0]
-    assert rule_header.children[0].data == "rule_name"
-    assert rule_header.children[0].children[0].value == "foo"
+    rule_name = tree.children[0].children[0].children[0]
+    assert rule_name.value == "foo"
 
-    rule_input = tree.children[0].children[0].children[1]
-    assert rule_input.children[0].data == "input_files"
+    rule_input = tree.children[0].children[0].children[1].children[0]
+    assert rule_input.data == "rule_input"
+    assert rule_input.children[0].data == "parameter_list"
     assert len(rule_input.children[0].children) == 1
-    assert rule_input.children[0].children[0].value == "file1.txt"
+    assert rule_input.children[0].children[0].children[0].value == '"file1.txt"'
 
-    rule_output = tree.children[0].children[0].children[2]
-    assert rule_output.children[0].data == "output_files"
+    rule_output = tree.children[0].children[0].children[2].children[0]
+    assert rule_output.data == "rule_output"
+    assert rule_output.children[0].data == "parameter_list"
     assert len(rule_output.children[0].children) == 1
-    assert rule_output.children[0].children[0].value == "output1.txt"
+    assert rule_output.children[0].children[0].children[0].value == '"output1.txt"'
+
+
+def test_diamond_comparison_operator_fails():
+    snakefile = """
+    x = a <> b
+    """
+    with pytest.raises(UnexpectedToken):
+        LARK.parse(dedent(snakefile))
 
 
 class TestIoDirectives:
@@ -189,7 +203,7 @@ class TestIoDirectives:
         rule foo:
             input: "file1.txt"
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_input")))[0]
         expected = [
@@ -207,7 +221,7 @@ class TestIoDirectives:
             output: 
                 file="output1.txt",
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_output")))[0]
         expected = [
@@ -241,7 +255,7 @@ class TestIoDirectives:
                 "output1.txt",
                 "output2.txt",
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_output")))[0]
         expected = [
@@ -264,7 +278,7 @@ class TestIoDirectives:
                 # only expect the output if test.txt is present before workflow execution
                 "out.txt" if exists("test.txt") else [],
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_input")))[0]
         expected = [
@@ -316,7 +330,7 @@ class TestIoDirectives:
             input:
                 rules.myrule.output,
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_input")))[0]
         expected = [
@@ -359,7 +373,7 @@ class TestIoDirectives:
             log: 
                 ["log1.txt", "log2.txt"]
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_log")))[0]
         expected = [
@@ -390,7 +404,7 @@ class TestIoDirectives:
                 "log1.txt",
                 file="log2.txt"
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_log")))[0]
         expected = [
@@ -421,7 +435,7 @@ class TestIoDirectives:
         rule foo:
             input: lambda wildcards: "data/{}.txt".format(wildcards.sample)
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_input")))[0]
         expected = [
@@ -500,7 +514,7 @@ class TestIoDirectives:
         rule foo:
             input: func
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_input")))[0]
         expected = [
@@ -517,7 +531,7 @@ class TestIoDirectives:
         rule foo:
             output: expand("output_{i}.txt", i=range(5))
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_output")))[0]
         expected = [
@@ -604,7 +618,7 @@ class TestIoDirectives:
             input:
                 *myfunc(),
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_input")))[0]
         expected = [
@@ -651,7 +665,7 @@ class TestIoDirectives:
                 *myfunc1(),
                 **myfunc2(),
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "rule_input")))[0]
         expected = [
@@ -716,7 +730,7 @@ class TestPriority:
         rule foo:
             priority: 50
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [Tree(Token("RULE", "number"), [Token("DEC_NUMBER", "50")])]
@@ -728,19 +742,32 @@ class TestPriority:
         rule foo:
             priority: 50.0
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [Tree(Token("RULE", "number"), [Token("FLOAT_NUMBER", "50.0")])]
 
         assert subtree.children == expected
 
+    def test_with_int_in_block(self):
+        snakefile = """
+        rule foo:
+            priority:
+                5
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "priority")))[0]
+        expected = [Tree(Token("RULE", "number"), [Token("DEC_NUMBER", "5")])]
+
+        assert subtree.children == expected
+
     def test_with_function_call(self):
         snakefile = """
         rule foo:
             priority: f()
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [
@@ -760,7 +787,7 @@ class TestPriority:
         rule foo:
             priority: bar
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [Tree("var", [Tree(Token("RULE", "name"), [Token("NAME", "bar")])])]
@@ -772,7 +799,7 @@ class TestPriority:
         rule foo:
             priority: 50 + 50
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [
@@ -793,7 +820,7 @@ class TestPriority:
         rule foo:
             priority: 50 + workflow.cores
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [
@@ -823,12 +850,40 @@ class TestPriority:
 
         assert subtree.children == expected
 
+    def test_with_parenthesised_arithmetic_expression(self):
+        snakefile = """
+        rule foo:
+            priority: (50 + 1) * 2
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "priority")))[0]
+        expected = [
+            Tree(
+                "term",
+                [
+                    Tree(
+                        "arith_expr",
+                        [
+                            Tree(Token("RULE", "number"), [Token("DEC_NUMBER", "50")]),
+                            Token("PLUS", "+"),
+                            Tree(Token("RULE", "number"), [Token("DEC_NUMBER", "1")]),
+                        ],
+                    ),
+                    Token("STAR", "*"),
+                    Tree(Token("RULE", "number"), [Token("DEC_NUMBER", "2")]),
+                ],
+            )
+        ]
+
+        assert subtree.children == expected
+
     def test_with_getitem_expression(self):
         snakefile = """
         rule foo:
             priority: workflow["cores"]
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [
@@ -851,7 +906,7 @@ class TestPriority:
         rule foo:
             priority: 50 if True else 100
         """
-        tree = LARK.parse(snakefile)
+        tree = LARK.parse(dedent(snakefile))
 
         subtree = list(tree.find_data(Token("RULE", "priority")))[0]
         expected = [
@@ -867,13 +922,13 @@ class TestPriority:
 
         assert subtree.children == expected
 
-    def test_with_arithmetic_expression_with_string_fails(self):
+    def test_with_string_fails(self):
         snakefile = """
         rule foo:
             priority: "50"
         """
         with pytest.raises(UnexpectedToken):
-            LARK.parse(snakefile)
+            LARK.parse(dedent(snakefile))
 
     def test_with_arithmetic_expression_with_string_fails(self):
         snakefile = """
@@ -881,7 +936,15 @@ class TestPriority:
             priority: "50" * 2
         """
         with pytest.raises(UnexpectedToken):
-            LARK.parse(snakefile)
+            LARK.parse(dedent(snakefile))
+
+    def test_with_inline_if_else_with_string_fails(self):
+        snakefile = """
+        rule foo:
+            priority: 1 if x else "a"
+        """
+        with pytest.raises(UnexpectedToken):
+            LARK.parse(dedent(snakefile))
 
     def test_with_lambda_fails(self):
         snakefile = """
@@ -889,7 +952,7 @@ class TestPriority:
             priority: lambda: 50
         """
         with pytest.raises(UnexpectedToken):
-            LARK.parse(snakefile)
+            LARK.parse(dedent(snakefile))
 
     def test_with_list_fails(self):
         snakefile = """
@@ -897,7 +960,7 @@ class TestPriority:
             priority: [50]
         """
         with pytest.raises(UnexpectedToken):
-            LARK.parse(snakefile)
+            LARK.parse(dedent(snakefile))
 
     def test_with_path_fails(self):
         snakefile = """
@@ -905,7 +968,7 @@ class TestPriority:
             priority: DIR / "file.txt"
         """
         with pytest.raises(UnexpectedToken):
-            LARK.parse(snakefile)
+            LARK.parse(dedent(snakefile))
 
     def test_with_assignment_fails(self):
         snakefile = """
@@ -913,4 +976,382 @@ class TestPriority:
             priority: a = 50
         """
         with pytest.raises(UnexpectedToken):
-            LARK.parse(snakefile)
+            LARK.parse(dedent(snakefile))
+
+
+class TestStringDirectives:
+    def test_shell_with_string(self):
+        snakefile = """
+        rule foo:
+            shell: "cat {input} > {output}"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [
+            Tree(Token("RULE", "string"), [Token("STRING", '"cat {input} > {output}"')])
+        ]
+
+        assert subtree.children == expected
+
+    def test_shell_with_long_string(self):
+        snakefile = '''
+        rule foo:
+            shell:
+                """
+                cat {input} > {output}
+                """
+        '''
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [
+            Tree(
+                "string_concat",
+                [
+                    Tree(
+                        Token("RULE", "string"),
+                        [
+                            Token(
+                                "LONG_STRING",
+                                '"""\n        cat {input} > {output}\n        """',
+                            )
+                        ],
+                    )
+                ],
+            )
+        ]
+
+        assert subtree.children == expected
+
+    def test_shell_with_concatenated_strings(self):
+        snakefile = """
+        rule foo:
+            shell: "cat {input} " "> {output}"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [
+            Tree(
+                Token("RULE", "string_concat"),
+                [
+                    Tree(Token("RULE", "string"), [Token("STRING", '"cat {input} "')]),
+                    Tree(Token("RULE", "string"), [Token("STRING", '"> {output}"')]),
+                ],
+            )
+        ]
+
+        assert subtree.children == expected
+
+    def test_shell_with_strings_on_consecutive_lines(self):
+        snakefile = """
+        rule foo:
+            shell:
+                "samtools sort {input} "
+                "> {output}"
+            message: "Sorting {input}"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [
+            Tree(
+                "string_concat",
+                [
+                    Tree(
+                        Token("RULE", "string"),
+                        [Token("STRING", '"samtools sort {input} "')],
+                    ),
+                    Tree(Token("RULE", "string"), [Token("STRING", '"> {output}"')]),
+                ],
+            )
+        ]
+
+        assert subtree.children == expected
+        assert len(list(tree.find_data(Token("RULE", "rule_message")))) == 1
+
+    def test_shell_with_format_call(self):
+        snakefile = """
+        rule foo:
+            shell: "cat {x}".format(x=1)
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [
+            Tree(
+                "funccall",
+                [
+                    Tree(
+                        "getattr",
+                        [
+                            Tree(
+                                Token("RULE", "string"), [Token("STRING", '"cat {x}"')]
+                            ),
+                            Tree(Token("RULE", "name"), [Token("NAME", "format")]),
+                        ],
+                    ),
+                    Tree(
+                        Token("RULE", "arguments"),
+                        [
+                            Tree(
+                                Token("RULE", "argvalue"),
+                                [
+                                    Tree(
+                                        "var",
+                                        [
+                                            Tree(
+                                                Token("RULE", "name"),
+                                                [Token("NAME", "x")],
+                                            )
+                                        ],
+                                    ),
+                                    Tree(
+                                        Token("RULE", "number"),
+                                        [Token("DEC_NUMBER", "1")],
+                                    ),
+                                ],
+                            )
+                        ],
+                    ),
+                ],
+            )
+        ]
+
+        assert subtree.children == expected
+
+    def test_shell_with_strings_on_consecutive_lines_and_format_call(self):
+        snakefile = """
+        rule foo:
+            shell:
+                "cat {x} "
+                "> {output}".format(x=1)
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [
+            Tree(
+                "funccall",
+                [
+                    Tree(
+                        "getattr",
+                        [
+                            Tree(
+                                "string_concat",
+                                [
+                                    Tree(
+                                        Token("RULE", "string"),
+                                        [Token("STRING", '"cat {x} "')],
+                                    ),
+                                    Tree(
+                                        Token("RULE", "string"),
+                                        [Token("STRING", '"> {output}"')],
+                                    ),
+                                ],
+                            ),
+                            Tree(Token("RULE", "name"), [Token("NAME", "format")]),
+                        ],
+                    ),
+                    Tree(
+                        Token("RULE", "arguments"),
+                        [
+                            Tree(
+                                Token("RULE", "argvalue"),
+                                [
+                                    Tree(
+                                        "var",
+                                        [
+                                            Tree(
+                                                Token("RULE", "name"),
+                                                [Token("NAME", "x")],
+                                            )
+                                        ],
+                                    ),
+                                    Tree(
+                                        Token("RULE", "number"),
+                                        [Token("DEC_NUMBER", "1")],
+                                    ),
+                                ],
+                            )
+                        ],
+                    ),
+                ],
+            )
+        ]
+
+        assert subtree.children == expected
+
+    def test_shell_with_variable(self):
+        snakefile = """
+        rule foo:
+            shell: CMD
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [Tree("var", [Tree(Token("RULE", "name"), [Token("NAME", "CMD")])])]
+
+        assert subtree.children == expected
+
+    def test_shell_with_string_plus_variable(self):
+        snakefile = """
+        rule foo:
+            shell: "cat " + x
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_shell")))[0]
+        expected = [
+            Tree(
+                Token("RULE", "arith_expr"),
+                [
+                    Tree(Token("RULE", "string"), [Token("STRING", '"cat "')]),
+                    Token("PLUS", "+"),
+                    Tree("var", [Tree(Token("RULE", "name"), [Token("NAME", "x")])]),
+                ],
+            )
+        ]
+
+        assert subtree.children == expected
+
+    def test_message_with_string(self):
+        snakefile = """
+        rule foo:
+            message: "Processing {input}"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_message")))[0]
+        expected = [
+            Tree(Token("RULE", "string"), [Token("STRING", '"Processing {input}"')])
+        ]
+
+        assert subtree.children == expected
+
+    def test_directives_belong_to_same_rule(self):
+        snakefile = """
+        rule foo:
+            input:
+                ref="ref.fa",
+            output: "ref.fa.bwt"
+            shell: "bwa index {input.ref}"
+
+        rule bar:
+            input: "ref.fa.bwt"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        ruledefs = list(tree.find_data(Token("RULE", "ruledef")))
+        directives = [
+            [param.children[0].data for param in ruledef.children[1:]]
+            for ruledef in ruledefs
+        ]
+        expected = [["rule_input", "rule_output", "rule_shell"], ["rule_input"]]
+
+        assert directives == expected
+
+    def test_shell_block_with_list_fails(self):
+        snakefile = """
+        rule foo:
+            shell:
+                ["cat", "{input}"]
+        """
+        with pytest.raises(UnexpectedToken):
+            LARK.parse(dedent(snakefile))
+
+
+class TestRuleBody:
+    def test_top_level_call_after_rule(self):
+        snakefile = """
+        rule foo:
+            input: "file1.txt"
+        shell.prefix("set -e;")
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        assert [child.data for child in tree.children] == ["snakemake", "expr_stmt"]
+        assert len(list(tree.find_data(Token("RULE", "ruleparams")))) == 1
+
+    def test_top_level_call_after_rule_and_blank_line(self):
+        snakefile = """
+        rule foo:
+            input: "file1.txt"
+
+        shell.executable("bash")
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        assert [child.data for child in tree.children] == ["snakemake", "expr_stmt"]
+
+    @mark.parametrize("keyword", ["log", "output", "message"])
+    def test_top_level_assignment_to_directive_name_after_rule(self, keyword):
+        snakefile = f"""
+        rule foo:
+            input: "file1.txt"
+        {keyword} = "x"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        assert [child.data for child in tree.children] == ["snakemake", "assign_stmt"]
+        assert len(list(tree.find_data(Token("RULE", "ruleparams")))) == 1
+
+    def test_other_directives(self):
+        snakefile = """
+        rule foo:
+            input: "file1.txt",
+            threads: 4
+            params:
+                extra="-v",
+            resources: mem_mb=1024
+            conda: "env.yaml"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        directives = list(tree.find_data(Token("RULE", "rule_directive")))
+        names = [directive.children[0] for directive in directives]
+
+        assert names == ["threads", "params", "resources", "conda"]
+        assert directives[0].children[1] == Tree(
+            Token("RULE", "parameter_list"),
+            [Tree(Token("RULE", "number"), [Token("DEC_NUMBER", "4")])],
+        )
+
+    def test_run_block(self):
+        snakefile = """
+        rule foo:
+            output: "output.txt"
+            run:
+                for f in output:
+                    print(f)
+                shell("touch {output}")
+            log: "log.txt"
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        ruledef = list(tree.find_data(Token("RULE", "ruledef")))[0]
+        directives = [param.children[0].data for param in ruledef.children[1:]]
+        subtree = list(tree.find_data(Token("RULE", "rule_run")))[0]
+
+        assert directives == ["rule_output", "rule_run", "rule_log"]
+        assert [child.data for child in subtree.children] == ["for_stmt", "expr_stmt"]
+
+    def test_run_inline(self):
+        snakefile = """
+        rule foo:
+            run: print("done")
+        """
+        tree = LARK.parse(dedent(snakefile))
+
+        subtree = list(tree.find_data(Token("RULE", "rule_run")))[0]
+
+        assert [child.data for child in subtree.children] == ["expr_stmt"]
+
+    def test_directives_on_same_line_fails(self):
+        snakefile = """
+        rule foo:
+            input: "file1.txt" output: "output1.txt"
+        """
+        with pytest.raises(UnexpectedToken):
+            LARK.parse(dedent(snakefile))